@@ -4,136 +4,376 @@
 """
 Aozora Corpus Builder (aozora.py)
 This script converts Aozora Bunko HTML files to UTF-8 plain-text, word-tokenized versions
-using MeCab and Beautiful Soup.
+using MeCab and lxml.
 Author: Molly Des Jardin
 License: MIT
 """
  
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timezone
-from bs4 import BeautifulSoup as bs
-from pathlib import Path
+from multiprocessing.util import Finalize
 import os
 import csv
+import hashlib
+import html
 import re
+import shutil
+import lxml.etree
+import lxml.html
 import MeCab
 
 rubytags = ['rt', 'rp']
+
+# XPath expression for the parser fallback in plaintext(): the class
+# match mirrors a CSS ".main_text" selector
+maintext_xpath = ('//div[contains(concat(" ", normalize-space(@class), " "),'
+                  ' " main_text ")]')
+
+# One parser instance, reused for every file in the process: the fixed
+# encoding skips libxml2's charset sniffing per document, and recover
+# keeps it lenient about the older files' markup
+htmlparser = lxml.html.HTMLParser(encoding='shift_jis', recover=True)
+
+# Patterns for the fast path in plaintext(): pull the "main_text" div out
+# of a standard file with string matching alone, no HTML parser needed.
+# The div regularly contains nested divs (indentation etc.), so the end is
+# anchored on the "bibliographical_information" div that always follows it.
+# These operate on the raw Shift-JIS bytes (safe because ASCII bytes like
+# '<' never appear inside multi-byte Shift-JIS characters), so only the
+# extracted work text ever gets decoded.
+maintext_re = re.compile(
+        rb'<div class="main_text">(.*?)</div>\s*'
+        rb'<div class="bibliographical_information"', re.S)
+# One fused pattern removes ruby gloss/punctuation tags (with contents)
+# and bare markup tags together, so the extracted text is scanned once;
+# the ruby alternative is listed first so <rt>/<rp> aren't consumed as
+# plain tags before their contents can be dropped
+striptags_re = re.compile(rb'<r[pt]>.*?</r[pt]>|<[^>]+>', re.S)
+
+# -Owakati treats newlines as plain whitespace and collapses them, so a
+# single parse call per text needs the line breaks marked with a sentinel
+# character that never appears in Aozora files. Kept whitespace-separated
+# it comes back as its own token, and splitting the output on it restores
+# the original lines.
+sentinel = '㊑'
+
+# Cache the working directory once at import; calling Path.cwd() per file
+# costs a getcwd syscall each time, and plain string joins are cheaper
+# than building Path objects in the per-file loop
+cwd = os.getcwd()
 localpath = 'aozorabunko_html/cards/'
+localbase = os.path.join(cwd, localpath)
 sourceurl = 'https://www.aozora.gr.jp'
-outpath = Path.cwd().joinpath('tokenized')
+sourcecards = sourceurl + '/cards/'
+outpath = os.path.join(cwd, 'tokenized')
 sourcecsv = 'list_person_all_extended_utf8.csv'
 
-# Create the tagger to reuse for all texts
+# Tagger to reuse for all texts, created once per worker process in
+# init_worker() (MeCab taggers can't be shared across processes)
 # (explicitly ignore config with -r /dev/null, specify dictionary with -d)
-tagger = MeCab.Tagger('-r ' + os.devnull + ' -d 60a_kindai-bungo -Owakati')
+tagger = None
+writer = None
+# Fingerprints of already-processed file contents (per worker), mapping
+# digest -> (output filename, write future): a file whose bytes were
+# already seen skips parsing and tokenization entirely and just copies
+# the earlier output
+seen = None
+
+def init_worker():
+    """
+    Creates the MeCab tagger in each worker process, since one tagger
+    can't be safely shared between processes, plus a small thread pool
+    that flushes output files while the worker parses the next one, and
+    the content-fingerprint dict for duplicate files.
+    """
+
+    global tagger, writer, seen
+    tagger = MeCab.Tagger('-r ' + os.devnull + ' -d 60a_kindai-bungo -Owakati')
+    # Output writes release the GIL in the write syscall, so handing them
+    # to background threads overlaps them with the next file's CPU work.
+    # atexit handlers don't run in pool worker processes, so the drain
+    # (shutdown waits on pending writes) is registered as a
+    # multiprocessing finalizer, which Process._bootstrap does run when
+    # the worker shuts down.
+    writer = ThreadPoolExecutor(max_workers=2)
+    Finalize(writer, writer.shutdown, exitpriority=10)
+    seen = {}
+
+
+def write_tokenized(path, parsed):
+    """
+    Saves one tokenized text, UTF-8 encoded. Runs on a worker's writer
+    thread. Encoding in one shot and writing the bytes skips the text
+    layer's incremental encoder and buffering.
+    """
+
+    with open(path, mode='wb') as fout:
+        fout.write(parsed.encode('utf-8'))
 
 # Dictionary of metadata, one list per row, filled in init_metadata()
-# Keys are filenames in format "[digits]-files-[html_filename].html"
-# The filenames are also stored in list files[] for faster processing
+# Keys are filenames in format "[digits]-files-[html_filename].html";
+# dicts keep insertion order, so the keys double as the ordered file list
 result_metadata = {}
-files = []
+csvheader = []
 
 def init_metadata():
     """
-    Initializes result_metadata{} with header from Aozora CSV.
+    Initializes result_metadata{} and csvheader[] from Aozora CSV.
     From Aozora CSV, reads HTML file URLs and saves metadata for each file
-    as an in-order list of fields corresponding to the header in
-    result_metadata (using local path as key). Filenames are stored in files[].
+    as an in-order list of fields corresponding to csvheader (using local
+    path as key).
     """
 
     with open (sourcecsv, newline='') as csvin:
         csvreader = csv.reader(csvin)
 
-        result_metadata['header'] = next(csvreader)
-        result_metadata['header'].append('Tokenized Filename')
-        result_metadata['header'].append('Time Processed (UTC)')
+        csvheader.extend(next(csvreader))
+        csvheader.append('Tokenized Filename')
+        csvheader.append('Time Processed (UTC)')
 
         for row in csvreader:
-            if sourceurl in row[50]:
+            if row[50].startswith(sourcecards):
             # Only store data for files hosted at Aozora URL
-                filepath = '-'.join(row[50].split('/')[4:])
-                if filepath not in files:
-                    files.append(filepath)
+                filepath = row[50].removeprefix(sourcecards).replace('/', '-')
+                # Keep the first row seen per file (constant-time probe)
+                if filepath not in result_metadata:
                     result_metadata[filepath] = row
-                    
 
-def ruby_replace(matchobj):
+
+def scan_local_files():
+    """
+    Walks the local Aozora folders once and returns a dict of the work
+    files actually on disk, keyed in the same "[digits]-files-[name].html"
+    format as result_metadata{}, mapped to each file's inode number. One directory
+    read per folder replaces a stat syscall per CSV entry in the main
+    loop, and the inodes come along for free from scandir.
+    """
+
+    found = {}
+    if os.path.isdir(localbase):
+        for card in os.scandir(localbase):
+            filesdir = os.path.join(card.path, 'files')
+            if card.is_dir() and os.path.isdir(filesdir):
+                for entry in os.scandir(filesdir):
+                    if entry.is_file():
+                        key = '-'.join((card.name, 'files', entry.name))
+                        found[key] = entry.inode()
+    return found
+
+
+def strip_oldruby(text):
     """
-    Find ruby annotation pattern for non-standard files, using matchobj regular expression.
-    Return the first (0th) string extracted from the ruby pattern, which
-    is the inline text (not gloss or punctuation).
+    Removes the "<!R>word（gloss）" ruby annotations used by the old
+    non-standard files, keeping only the inline word. A plain find/slice
+    scan runs as C string operations per annotation, with none of the
+    regex engine's per-match bookkeeping.
     """
 
-    return matchobj.string[4:].split('（')[0]
+    out = []
+    prev = 0
+    i = text.find('<!R>')
+    while i != -1:
+        j = text.find('（', i)
+        k = text.find('）', j)
+        if j == -1 or k == -1:
+            break
+        out.append(text[prev:i])
+        out.append(text[i + 4:j])
+        prev = k + 1
+        i = text.find('<!R>', prev)
+    out.append(text[prev:])
+    return ''.join(out)
 
 
-def plaintext(f):
+def plaintext(filebytes):
     """
-    Removes ruby (annotation and gloss) and HTML markup tags.
+    Removes ruby (annotation and gloss) and HTML markup tags from the
+    raw Shift-JIS bytes of one file. Decoding is deferred until the work
+    text has been extracted, so the markup around it (and on the parser
+    path, the whole file) is never decoded in Python.
     If successful, returns plain text string of work content.
     If failure, returns empty string.
     """
 
-    with open(f, mode='r', encoding='Shift-JIS', errors='ignore') as fin:
-        filetext = fin.read()
-        
+    # Fast path for standard files: grab the "main_text" div with string
+    # matching, then remove ruby gloss/punctuation tags (with contents)
+    # and all other markup -- including any <br /> -- in a single pass.
+    # Skips building a parse tree.
+    match = maintext_re.search(filebytes)
+    if match:
+        maintext = striptags_re.sub(b'', match.group(1))
+        return html.unescape(maintext.decode('shift_jis', errors='ignore'))
+
     # Delete excess <br /> present in older files that don't have <p> tags,
     # to prevent output from having excessive line-break whitespace.
-    filetext = filetext.replace("<br />", "")
+    filebytes = filebytes.replace(b"<br />", b"")
+
+    # Cheap bytewise probe before building a tree: files without the
+    # "main_text" div at all (the old non-standard ones) go straight to
+    # the body fallback instead of being parsed twice
+    if b'class="main_text"' in filebytes:
+        # Parse with lxml.html directly (libxml2 decodes the Shift-JIS
+        # bytes itself, and no wrapper object is built per node)
+        try:
+            tree = lxml.html.document_fromstring(filebytes,
+                                                 parser=htmlparser)
+        except lxml.etree.ParserError:
+            # Nothing parseable in the file; treat as unprocessable
+            return ""
+        nodes = tree.xpath(maintext_xpath)
 
-    soup = bs(filetext, "html5lib").select(".main_text")
+        # Default case, remove the ruby tags from the tree, return text
+        # (strip_elements deletes every rt/rp inside libxml2 instead of
+        # a Python loop per tag, and text_content() walks the tree in C)
+        if len(nodes) == 1:
+            lxml.etree.strip_elements(nodes[0], *rubytags, with_tail=False)
+            return nodes[0].text_content()
 
-    # Default case, use Beautiful Soup parser to remove ruby, return text
-    if len(soup) == 1:
-        for tag in soup[0].find_all(rubytags):
-            tag.extract()
-        return soup[0].text
+        # Skip processing for unexpected cases (several "main_text" divs)
+        elif len(nodes) > 1:
+            return ""
 
     # If no "main_text" div found:
-    #   - Use regex match to retain glossed word without ruby or punctuation
-    #   - Use Beautiful Soup parser to return text within <body> tag
-    elif len(soup) == 0:
-        nonruby = re.sub(r"<!R>.*?（.*?）", ruby_replace, filetext)
-        soup = bs(nonruby, "html5lib").find("body")
-        return soup.text
-
-    # Skip processing for other unexpected cases
-    else:
+    #   - Use string match to retain glossed word without ruby or punctuation
+    #   - Parse and return the text within the <body> tag
+    # The old-style ruby pattern mixes markup and multi-byte text, so
+    # this path needs one decode of the whole file before substituting
+    filetext = filebytes.decode('shift_jis', errors='ignore')
+    nonruby = strip_oldruby(filetext)
+    # Empty, whitespace-only, or comment-only input makes lxml raise
+    # ParserError ("Document is empty") instead of returning a tree;
+    # those files are unprocessable, same as having no body
+    try:
+        body = lxml.html.document_fromstring(nonruby).xpath('//body')
+    except lxml.etree.ParserError:
         return ""
+    if body:
+        return body[0].text_content()
+    return ""
+
+
+def process_file(filename):
+    """
+    Runs the whole pipeline for one file (remove ruby and HTML markup,
+    tokenize, save output txt file). The caller has already checked that
+    the file exists via scan_local_files().
+    Returns (filename, output filename, timestamp) on success, or
+    (filename, '', '') if the file couldn't be processed.
+    """
+
+    inpath = os.path.join(localbase, filename.replace('-', '/'))
+    with open(inpath, mode='rb') as fin:
+        filebytes = fin.read()
+    outfilename = 't-' + filename[:-5] + '.txt'
+
+    # Identical bytes mean identical output: if this worker already
+    # processed a file with the same fingerprint, copy its output
+    # (hashing is much cheaper than parsing and tokenizing again)
+    digest = hashlib.blake2b(filebytes, digest_size=16).digest()
+    duplicate = seen.get(digest)
+    if duplicate is not None:
+        earliername, earlierwrite = duplicate
+        # Make sure the earlier output has finished writing before the
+        # copy is queued behind it
+        earlierwrite.result()
+        writer.submit(shutil.copyfile, os.path.join(outpath, earliername),
+                      os.path.join(outpath, outfilename))
+        return (filename, outfilename,
+                datetime.now(timezone.utc).isoformat(timespec='seconds'))
+
+    # 1. Remove ruby
+    # 2. Get only "main" work text (no HTML tags or metadata)
+    text = plaintext(filebytes)
+
+    # 3. Tokenize using MeCab & save output txt file
+    if text:
+        textlines = text.split('\n')
+        if sentinel not in text:
+            # One parse call per text: mark the line breaks with the
+            # sentinel, tokenize everything at once, then re-split on it
+            # to restore the original line structure
+            batch = ('\n' + sentinel + '\n').join(textlines)
+            parsedlines = [part.strip()
+                           for part in tagger.parse(batch).split(sentinel)]
+        else:
+            # The sentinel character actually occurs in this text
+            # (vanishingly rare), so tokenize line by line instead
+            parsedlines = [tagger.parse(line).strip() for line in textlines]
+        parsed = '\n'.join(parsedlines).strip()
+        seen[digest] = (outfilename,
+                        writer.submit(write_tokenized,
+                                      os.path.join(outpath, outfilename),
+                                      parsed))
+        # Second precision is plenty for a per-file timestamp, and
+        # isoformat() is cheaper than the str() slow path
+        return (filename, outfilename,
+                datetime.now(timezone.utc).isoformat(timespec='seconds'))
+    return (filename, '', '')
+
+
+def write_csv_row(fout, w, row):
+    """
+    Writes one metadata row. Most Aozora rows contain no commas, quotes,
+    or line breaks in any field, so the common case joins the fields
+    directly instead of running csv.writer's per-field quoting state
+    machine; rows that do need quoting fall back to csv.writer.
+    """
+
+    if any(c in field for field in row for c in ',"\r\n'):
+        w.writerow(row)
+    else:
+        fout.write(','.join(row))
+        fout.write('\r\n')
 
 
 def main():
 
-    if (not(outpath.exists())):
-        outpath.mkdir()    
+    if (not(os.path.exists(outpath))):
+        os.mkdir(outpath)
     init_metadata()
 
-    for filename in files:
-        inpath = Path.cwd().joinpath(localpath + filename.replace('-', '/'))
-
-        # 1. Remove ruby
-        # 2. Get only "main" work text (no HTML tags or metadata)
-        if inpath.is_file():
-            text = plaintext(inpath)
-
-        # 3. Tokenize using MeCab & save output txt file
-            if text:
-                textlines = text.split('\n')
-                parsedlines = [tagger.parse(line).strip() for line in textlines]
-                parsed = '\n'.join(parsedlines).strip()
-                outfilename = 't-' + filename[:-5] + '.txt'
-                with open(outpath.joinpath(outfilename), mode='w', encoding='utf-8') as fout:
-                    fout.write(parsed)
-                result_metadata[filename].append(outfilename)
-                result_metadata[filename].append(str(datetime.now(timezone.utc)))
+    # Find which CSV entries are actually on disk with one directory
+    # walk, instead of a stat syscall per entry inside the loop
+    existing = scan_local_files()
+
+    # The insertion-ordered metadata keys are the canonical file list;
+    # snapshot them since rows are dropped from the dict once written
+    files = list(result_metadata)
 
     # Save CSV with all original Aozora metadata per each file (row), plus
-    # output filename and processing timestamp as extra columns
-    outcsv = Path.cwd().joinpath('t-list_person_all_extended_utf8.csv')
+    # output filename and processing timestamp as extra columns.
+    # Rows are streamed out as each file finishes instead of buffered
+    # until the end of the run, so partial results survive an abort.
+    # Each file is independent, so the per-file work is spread over one
+    # worker process per CPU (each with its own tagger).
+    outcsv = os.path.join(cwd, 't-list_person_all_extended_utf8.csv')
     with open(outcsv, mode='w', encoding='utf-8') as fout:
         w = csv.writer(fout)
-        w.writerow(result_metadata['header'])
+        w.writerow(csvheader)
+        with ProcessPoolExecutor(max_workers=os.cpu_count(),
+                                 initializer=init_worker) as executor:
+            # Only files present on disk are dispatched to the pool, in
+            # inode order so that opens walk the disk roughly
+            # sequentially (readahead-friendly) instead of jumping
+            # around in CSV order
+            todo = sorted((f for f in files if f in existing),
+                          key=existing.get)
+            for filename, outfilename, timestamp in executor.map(
+                    process_file, todo, chunksize=32):
+                if outfilename:
+                    result_metadata[filename].append(outfilename)
+                    result_metadata[filename].append(timestamp)
+                write_csv_row(fout, w, result_metadata[filename])
+                fout.flush()
+                # The row is on disk; drop it so memory stays bounded
+                # instead of holding every row until the run ends
+                del result_metadata[filename]
+
+        # Entries with no local file still get their metadata row (with
+        # the two extra columns left blank), after the processed works
         for filename in files:
-            w.writerow(result_metadata[filename])
+            if filename not in existing:
+                write_csv_row(fout, w, result_metadata[filename])
 
-main()
+if __name__ == '__main__':
+    main()